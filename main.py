@@ -1,19 +1,44 @@
-from bs4 import BeautifulSoup as BS
-from bs4.element import Tag
-from dataclasses import dataclass, asdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from functools import lru_cache
+from html import unescape
+from io import BytesIO
+from lxml import etree
+from operator import attrgetter
 from time import time
-from typing import Literal, Union
-import json as js
+from typing import Iterator, Literal, Union
+import msgspec
 import re
 import requests as req
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from extras.langmap import char_maps
 
 MAIN_URL = "https://anitrakt.huere.net/db/db_index_{0}.php"
+SEASON_RE = re.compile(r'[A-Za-z](\d+)\s*<a\s[^>]*?href="[^"]*/(\d+)"[^>]*>([^<]*)</a>')
+"""Season number, MAL ID, and MAL title of a season in the shows table"""
+TIMEOUT = 30
+"""Request timeout in seconds"""
 
-@dataclass
-class BaseType:
+DIGITS_RE = re.compile(r"^\d+$")
+NON_WORD_RE = re.compile(r"[^\w\s]")
+DASH_RE = re.compile(r"[\s_\-]+")
+TRIM_RE = re.compile(r"^-+|-+$")
+CHAR_ORDER = {k: i for i, k in enumerate(char_maps)}
+CHAR_TABLE = str.maketrans({k: v for k, v in char_maps.items() if len(k) == 1})
+"""Single character replacements from langmap, applied in one pass"""
+MULTI_CHAR_MAPS = [
+    (k, v) for i, (k, v) in enumerate(char_maps.items())
+    # skip keys with a character replaced by an earlier single character key,
+    # the replacement loop this replaces never matched them
+    if len(k) > 1 and all(CHAR_ORDER.get(ch, i) >= i for ch in k)
+]
+"""Multi character replacements from langmap, applied before CHAR_TABLE"""
+MINIFY_TABLE = str.maketrans("", "", "\n\t\r")
+"""Whitespace characters removed from the html content"""
+
+class BaseType(msgspec.Struct, frozen=True, gc=False):
     title: str
     """Work title"""
     mal_id: int
@@ -23,13 +48,11 @@ class BaseType:
     guessed_slug: str | None
     """Guessed slug for Trakt"""
 
-@dataclass
 class Movie(BaseType):
     """Movie type"""
     type: Literal["movies"] = "movies"
     """Type of the media"""
 
-@dataclass
 class Show(BaseType):
     """Show type"""
     season: int
@@ -37,6 +60,34 @@ class Show(BaseType):
     type: Literal["shows"] = "shows"
     """Type of the media"""
 
+DECODERS = {
+    "movies": msgspec.json.Decoder(list[Movie]),
+    "shows": msgspec.json.Decoder(list[Show]),
+}
+"""Overwrite data decoders, decode straight into the media type"""
+ENCODER = msgspec.json.Encoder()
+"""Database encoder, encodes the media structs without converting them first"""
+
+def create_session() -> req.Session:
+    """
+    Create a HTTP session, reused for every request to AniTrakt
+    :return: The session
+    :rtype: req.Session
+    """
+    session = req.Session()
+    session.headers.update({
+        "Accept-Encoding": "gzip, deflate",
+        "User-Agent": "anitrakt-db/1.0",
+    })
+    adapter = HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=4,
+        max_retries=Retry(total=3, backoff_factor=0.5),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
 def push_time() -> None:
     """
     Push the current time to the filesystem
@@ -44,6 +95,7 @@ def push_time() -> None:
     with open("updated.txt", "w") as f:
         f.write(datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"))
 
+@lru_cache(maxsize=8192)
 def slugify(title: str) -> str | None:
     """
     Slugify the title
@@ -53,16 +105,17 @@ def slugify(title: str) -> str | None:
     :rtype: str
     """
     # if title only have numbers, return None
-    if re.match(r"^\d+$", title):
+    if DIGITS_RE.match(title):
         print(f"  Error: {title}, Title only have numbers. To avoid Trakt conflict, skipping")
         return None
     lower = title.lower().strip()
     # replace characters from langmap
-    for k, v in char_maps.items():
+    for k, v in MULTI_CHAR_MAPS:
         lower = lower.replace(k, v)
-    alpha = re.sub(r"[^\w\s]", "-", lower)
-    dash = re.sub(r"[\s_\-]+", "-", alpha)
-    trim_corner = re.sub(r"^-+|-+$", "", dash)
+    lower = lower.translate(CHAR_TABLE)
+    alpha = NON_WORD_RE.sub("-", lower)
+    dash = DASH_RE.sub("-", alpha)
+    trim_corner = TRIM_RE.sub("", dash)
     return trim_corner
 
 def minify_html(html: str) -> str:
@@ -74,56 +127,115 @@ def minify_html(html: str) -> str:
     :rtype: str
     """
     print("Minifying HTML")
-    return html.replace("\n", "")\
-        .replace("\t", "")\
-        .replace("(  )*", "")\
-        .replace("\r", "")
+    return html.translate(MINIFY_TABLE)
 
 def push_html(html: str, media_type: Literal["movies", "shows"]) -> None:
     """
-    Push the html content to the filesystem
+    Push the html content to the filesystem, skipped if the content is
+    unchanged
     :param html: The html content
     :type html: str
     :param media_type: The media type
     :type media_type: Literal["movies", "shows"]
     """
+    if pull_html(media_type) == html:
+        print(f"{media_type} HTML is unchanged, skipping push")
+        return
     print(f"Pushing {media_type} HTML")
     with open(f"{media_type}.html", "w") as f:
         f.write(html)
 
-def select_node(html: str) -> Tag:
+def pull_html(media_type: Literal["movies", "shows"]) -> str | None:
+    """
+    Pull the html content pushed by previous run from the filesystem
+    :param media_type: The media type
+    :type media_type: Literal["movies", "shows"]
+    :return: The html content, None if not found
+    :rtype: str | None
+    """
+    try:
+        with open(f"{media_type}.html", "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def push_etag(etag: str, media_type: Literal["movies", "shows"]) -> None:
+    """
+    Push the ETag of the fetched page to the filesystem
+    :param etag: The ETag
+    :type etag: str
+    :param media_type: The media type
+    :type media_type: Literal["movies", "shows"]
+    """
+    with open(f"{media_type}.etag", "w") as f:
+        f.write(etag)
+
+def pull_etag(media_type: Literal["movies", "shows"]) -> str | None:
+    """
+    Pull the ETag of the page fetched by previous run from the filesystem
+    :param media_type: The media type
+    :type media_type: Literal["movies", "shows"]
+    :return: The ETag, None if not found
+    :rtype: str | None
     """
-    Select the node from the html content
+    try:
+        with open(f"{media_type}.etag", "r") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def iter_rows(html: str) -> Iterator[etree._Element]:
+    """
+    Stream the table body rows from the html content, each row is freed
+    after it is processed
     :param html: The html content
     :type html: str
-    :return: The selected node
-    :rtype: Tag
-    """
-    print("Selecting node")
-    parsed = BS(html, "html.parser")
-    parsed = parsed.find("tbody")
-    # only return if BS.Tag
-    if type(parsed) == Tag:
-        return parsed
-    raise TypeError("Node is not found")
+    :return: The table body rows
+    :rtype: Iterator[etree._Element]
+    """
+    print("Selecting rows")
+    found = False
+    for _, tr in etree.iterparse(BytesIO(html.encode("utf-8")), tag="tr", html=True, encoding="utf-8"):
+        parent = tr.getparent()
+        if parent is not None and parent.tag == "tbody":
+            found = True
+            yield tr
+        # drop the row and the rows before it, they are no longer needed
+        tr.clear()
+        while tr.getprevious() is not None:
+            del tr.getparent()[0]
+    if not found:
+        raise TypeError("Node is not found")
 
-def push_db(data: list[Union[Movie, Show]], media_type: Literal["movies", "shows"]) -> None:
+def push_db(data: list[Union[Movie, Show]], media_type: Literal["movies", "shows"]) -> bool:
     """
-    Push the database to the filesystem
+    Push the database to the filesystem, skipped if the content is unchanged
     :param data: The data
     :type data: list[Union[Movie, Show]]
     :param media_type: The media type
     :type media_type: Literal["movies", "shows"]
+    :return: Whether the database is changed
+    :rtype: bool
     """
     mtype = media_type
     if mtype == "shows":
         mtype = "tv"
     # sort by title
     print(f"Sorting {mtype} data")
-    sdata = sorted(data, key=lambda x: x.title)
+    sdata = sorted(data, key=attrgetter("title"))
+    encoded = msgspec.json.format(ENCODER.encode(sdata), indent=2)
+    path = f"db/{mtype}.json"
+    try:
+        with open(path, "rb") as f:
+            if f.read() == encoded:
+                print(f"{mtype} data is unchanged, skipping push")
+                return False
+    except FileNotFoundError:
+        pass
     print(f"Pushing {mtype} data")
-    with open(f"db/{mtype}.json", "w") as f:
-        js.dump([asdict(d) for d in sdata], f, indent=2, ensure_ascii=False)
+    with open(path, "wb") as f:
+        f.write(encoded)
+    return True
 
 def pull_db(media_type: Literal["movies", "shows"]) -> list[Union[Movie, Show]]:
     """
@@ -138,9 +250,8 @@ def pull_db(media_type: Literal["movies", "shows"]) -> list[Union[Movie, Show]]:
     if mtype == "shows":
         mtype = "tv"
     print(f"Pulling {mtype} overwrite data")
-    with open(f"db/overwrite_{mtype}.json", "r") as f:
-        data = js.load(f)
-    return [Movie(**d) if media_type == "movies" else Show(**d) for d in data]
+    with open(f"db/overwrite_{mtype}.json", "rb") as f:
+        return DECODERS[media_type].decode(f.read())
 
 def overwrite_db(data: list[Union[Movie, Show]], media_type: Literal["movies", "shows"]) -> list[Union[Movie, Show]]:
     """
@@ -155,112 +266,174 @@ def overwrite_db(data: list[Union[Movie, Show]], media_type: Literal["movies", "
     if (not ow_data) or len(ow_data) == 0:
         print("No overwrite data found")
         return data
-    for d in ow_data:
-        av_malid = [x.mal_id for x in data]
-        if d.mal_id not in av_malid:
-            data.append(d)
-        # overwrite if exist
-        elif d.mal_id in av_malid:
-            for i, x in enumerate(data):
-                if x.mal_id == d.mal_id:
-                    data[i] = d
+    # last overwrite entry wins if a MAL ID is listed more than once
+    ow_malid = {d.mal_id: d for d in ow_data}
+    replaced = set()
+    for i, x in enumerate(data):
+        if x.mal_id in ow_malid:
+            data[i] = ow_malid[x.mal_id]
+            replaced.add(x.mal_id)
+    # append overwrite entries that are not parsed
+    data.extend(d for mal_id, d in ow_malid.items() if mal_id not in replaced)
     return data
 
-def parse_movies(node: Tag) -> list[Movie]:
+def parse_movies(rows: Iterator[etree._Element]) -> list[Movie]:
     """
     Parse the movies
-    :param node: The node
-    :type node: Tag
+    :param rows: The table body rows
+    :type rows: Iterator[etree._Element]
     :return: The parsed movies
     :rtype: list[Movie]
     """
     data: list[Movie] = []
-    for tr in node.find_all("tr"):
-        trakt = tr.find_all("td")[0].a
+    for tr in rows:
+        td = tr.findall("td")
+        trakt = td[0].find(".//a")
+        trakt_title = "".join(trakt.itertext())
         try:
-            mal = tr.find_all("td")[1].a
+            mal = td[1].find(".//a")
         except IndexError:
-            print(f"Error: {trakt.text}, MyAnimeList link is not found")
+            mal = None
+        if mal is None:
+            print(f"Error: {trakt_title}, MyAnimeList link is not found")
             continue
-        mal_id = int(mal["href"].split("/")[-1])
-        trakt_id = int(trakt["href"].split("/")[-1])
-        print(f"Processing \"{trakt.text}\", MAL ID: {mal_id}, Trakt ID: {trakt_id}")
+        mal_id = int(mal.get("href").split("/")[-1])
+        trakt_id = int(trakt.get("href").split("/")[-1])
+        print(f"Processing \"{trakt_title}\", MAL ID: {mal_id}, Trakt ID: {trakt_id}")
         data.append(Movie(
-            title=mal.text or trakt.text,
+            title="".join(mal.itertext()) or trakt_title,
             mal_id=mal_id,
             trakt_id=trakt_id,
-            guessed_slug=slugify(trakt.text)
+            guessed_slug=slugify(trakt_title)
         ))
     data = overwrite_db(data, "movies") # type: ignore
     if type(data[0]) == Movie:
         return data  # type: ignore
     raise TypeError("Data is not Movie type")
 
-def parse_shows(node: Tag) -> list[Show]:
+def parse_seasons(cell: etree._Element) -> list[tuple[int, int, str]]:
+    """
+    Parse the seasons listed in a MyAnimeList cell of the shows table
+    :param cell: The cell, seasons are separated by <br>
+    :type cell: etree._Element
+    :return: The MAL ID, season number, and MAL title of each season
+    :rtype: list[tuple[int, int, str]]
+    """
+    html = etree.tostring(cell, encoding="unicode", method="html", with_tail=False)
+    seasons = [
+        (int(m.group(2)), int(m.group(1)), unescape(m.group(3)))
+        for m in SEASON_RE.finditer(html)
+    ]
+    links = cell.findall(".//a")
+    if seasons and len(seasons) == len(links):
+        return seasons
+    # fallback to walk the cell if the layout changed, the season number is
+    # in the text before each link
+    seasons = []
+    for mal in links:
+        prev = mal.getprevious()
+        text = cell.text if prev is None else prev.tail
+        if not text or not text.split():
+            raise Exception("Season is not found")
+        mal_id = int(mal.get("href").split("/")[-1])
+        season_number = int(text.split()[0][1:])
+        seasons.append((mal_id, season_number, "".join(mal.itertext())))
+    if not seasons:
+        raise Exception("MyAnimeList link is not found")
+    return seasons
+
+def parse_shows(rows: Iterator[etree._Element]) -> list[Show]:
     """
     Parse the shows
-    :param node: The node
-    :type node: Tag
+    :param rows: The table body rows
+    :type rows: Iterator[etree._Element]
     :return: The parsed shows
     :rtype: list[Show]
     """
     data: list[Show] = []
-    for tr in node.find_all("tr"):
-        td = tr.find_all("td")
+    for tr in rows:
+        td = tr.findall("td")
         trakt = td[0]
-        trakt_link = trakt.a["href"]
+        trakt_link = trakt.find(".//a").get("href")
         trakt_id = int(trakt_link.split("/")[-1])
+        # every season shares the Trakt title, only slugify it once
+        trakt_title = "".join(trakt.itertext())
+        guessed_slug = slugify(trakt_title)
         try:
-            # split by <br>
-            mal_seasons = str(td[1])
-            mal_seasons = mal_seasons.split("<br/>")
-            for season in mal_seasons:
-                season = BS(season, "html.parser")
-                if not season:
-                    raise Exception("Season is not found")
-                mal = season.a
-                if not mal:
-                    raise Exception("MyAnimeList link is not found")
-                mal_id = int(mal["href"].split("/")[-1])  # type: ignore
-                season_number = int(season.text.split()[0][1:])
-                print(f"Processing \"{trakt.text}\", MAL ID: {mal_id}, Trakt ID: {trakt_id}, Season: {season_number}")
+            for mal_id, season_number, mal_title in parse_seasons(td[1]):
+                print(f"Processing \"{trakt_title}\", MAL ID: {mal_id}, Trakt ID: {trakt_id}, Season: {season_number}")
                 data.append(Show(
-                    title=mal.text or trakt.text,
+                    title=mal_title or trakt_title,
                     mal_id=mal_id,
                     trakt_id=trakt_id,
                     season=season_number,
-                    guessed_slug=slugify(trakt.text)
+                    guessed_slug=guessed_slug
                 ))
         except Exception as e:
-            Exception(f"  Error: {trakt.text}, {e}")
+            Exception(f"  Error: {trakt_title}, {e}")
     data = overwrite_db(data, "shows")  # type: ignore
     if type(data[0]) == Show:
         return data  # type: ignore
     raise TypeError("Data is not Show type")
 
+def process_media(session: req.Session, media_type: Literal["movies", "shows"]) -> bool | None:
+    """
+    Fetch, parse, and push the database of a media type
+    :param session: The HTTP session
+    :type session: req.Session
+    :param media_type: The media type
+    :type media_type: Literal["movies", "shows"]
+    :return: Whether the database is changed, None if the media type failed
+    :rtype: bool | None
+    """
+    print(f"Processing {media_type}")
+    cached = pull_html(media_type)
+    etag = pull_etag(media_type)
+    headers = {}
+    # only ask for a conditional response if the cached page is still there
+    if cached is not None and etag:
+        headers["If-None-Match"] = etag
+    resp = session.get(MAIN_URL.format(media_type), headers=headers, timeout=TIMEOUT)
+    if resp.status_code == 304 and cached is not None:
+        print(f"{media_type} is not modified, using cached HTML")
+        html = cached
+    elif resp.status_code != 200:
+        print(f"Error: {resp.status_code}")
+        return None
+    else:
+        html = resp.text
+        html = minify_html(html)
+        push_html(html, media_type)
+        if resp.headers.get("ETag"):
+            push_etag(resp.headers["ETag"], media_type)
+    rows = iter_rows(html)
+    print(f"Processing {media_type}")
+    if media_type == "movies":
+        data = parse_movies(rows)
+    else:
+        data = parse_shows(rows)
+    return push_db(data, media_type) # type: ignore
+
 def main() -> None:
     """
     The main function
     """
     start = time()
-    for media_type in ["movies", "shows"]:
-        print(f"Processing {media_type}")
-        resp = req.get(MAIN_URL.format(media_type))
-        if resp.status_code != 200:
-            print(f"Error: {resp.status_code}")
-            return
-        html = resp.text
-        html = minify_html(html)
-        push_html(html, media_type) # type: ignore
-        node = select_node(html)
-        print(f"Processing {media_type}")
-        if media_type == "movies":
-            data = parse_movies(node)
-        else:
-            data = parse_shows(node)
-        push_db(data, media_type) # type: ignore
+    session = create_session()
+    # both media types are independent, fetch them concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(
+            lambda media_type: process_media(session, media_type),
+            ["movies", "shows"],
+        ))
+    if None in results:
+        return
 
-    push_time()
+    # only bump the timestamp if at least one database is changed
+    if any(results):
+        push_time()
+    else:
+        print("No changes made, skipping time push")
     print(f"Finished in {time() - start:.2f} seconds")
     exit(0)
 